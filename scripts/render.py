@@ -2,33 +2,78 @@
 """Minimal renderer for YTA JA senior habit slides."""
 from __future__ import annotations
 
+import copy
+import functools
+import os
+import re
+import subprocess
 import sys
-import textwrap
+import tempfile
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import yaml
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+try:
+    from yaml import CSafeLoader as _YamlLoader  # libyaml-backed, much faster
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+
+# Parsed configs keyed by path, revalidated via stat so edits are picked up.
+_config_cache: OrderedDict[str, tuple[float, int, dict]] = OrderedDict()
+_CONFIG_CACHE_MAX = 16
+
+
 def load_config(config_path: Path) -> dict:
     if not config_path.exists():
         raise FileNotFoundError(f"Config not found: {config_path}")
+    key = str(config_path)
+    st = config_path.stat()
+    cached = _config_cache.get(key)
+    if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        _config_cache.move_to_end(key)
+        return copy.deepcopy(cached[2])
     with config_path.open("r", encoding="utf-8") as fh:
+        cfg = yaml.load(fh, Loader=_YamlLoader) or {}
+    _config_cache[key] = (st.st_mtime, st.st_size, cfg)
+    _config_cache.move_to_end(key)
+    while len(_config_cache) > _CONFIG_CACHE_MAX:
+        _config_cache.popitem(last=False)
+    return copy.deepcopy(cfg)
+
+
+# H1 title or bullet line, matched in one C-level scan over the body.
+# Whitespace is [ \t] only: \s would match newlines and let a bare "#" or
+# "-" line swallow the line after it. The capture starts at \S so a marker
+# followed by nothing but whitespace is skipped, like the old loop did.
+_TITLE_OR_BULLET = re.compile(
+    r"(?m)^[ \t]*(?:#[ \t]+(?P<title>\S.*?)|-[ \t]+(?P<bullet>\S.*?))[ \t]*$"
+)
+
 
 def parse_markdown(md_path: Path) -> tuple[dict, str, list[str]]:
     content = md_path.read_text(encoding="utf-8")
-    parts = content.split("---")
-    if len(parts) < 3:
+    if not content.startswith("---"):
+        raise ValueError("Markdown missing frontmatter")
+    end = content.find("\n---", 3)
+    if end < 0:
         raise ValueError("Markdown missing frontmatter")
-        
-    body = "---".join(parts[2:]).strip()
+    frontmatter = yaml.load(content[3:end], Loader=_YamlLoader) or {}
+    body = content[end + 4 :].strip()
 
     title = ""
     bullets: list[str] = []
-    for line in body.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        if line.startswith("# ") and not title:
-            title = line[2:].strip()
-        elif line.startswith("- "):
-            bullets.append(line[2:].strip())
+    for match in _TITLE_OR_BULLET.finditer(body):
+        heading = match.group("title")
+        if heading is not None:
+            if not title:
+                title = heading
+        else:
+            bullets.append(match.group("bullet"))
     if not title:
         raise ValueError("Title (H1) missing in markdown body")
     if not bullets:
@@ -36,6 +81,7 @@ def parse_markdown(md_path: Path) -> tuple[dict, str, list[str]]:
     return frontmatter, title, bullets
 
 
+@functools.lru_cache(maxsize=8)
 def load_font(path: str | None, size: int) -> ImageFont.FreeTypeFont:
     if not path:
         return ImageFont.load_default()
@@ -47,90 +93,330 @@ def load_font(path: str | None, size: int) -> ImageFont.FreeTypeFont:
 
 
 def wrap_lines(text: str, max_chars: int, max_lines: int = 2) -> list[str]:
-    raw_lines = textwrap.wrap(text, width=max_chars) or [text]
-    if len(raw_lines) <= max_lines:
-        return raw_lines
-    trimmed = raw_lines[:max_lines]
+    # max_chars is budgeted in full-width (CJK) characters; half-width
+    # characters cost half a slot, so mixed ASCII/JA text fills lines
+    # proportionally. Greedy slicing replaces textwrap, whose word-boundary
+    # machinery does nothing useful for spaceless Japanese text.
+    budget = max_chars * 2
+    lines: list[str] = []
+    current: list[str] = []
+    used = 0
+    for ch in text:
+        cost = 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+        if current and used + cost > budget:
+            lines.append("".join(current))
+            current = []
+            used = 0
+        current.append(ch)
+        used += cost
+    if current or not lines:
+        lines.append("".join(current))
+    if len(lines) <= max_lines:
+        return lines
+    # Truncate by the same half-width budget used for wrapping, leaving a
+    # full-width slot for the ellipsis.
+    trimmed = lines[:max_lines]
     ellipsis = "…"
-    trimmed[-1] = trimmed[-1][: max(0, max_chars - 1)] + ellipsis
+    kept: list[str] = []
+    used = 0
+    for ch in trimmed[-1]:
+        cost = 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+        if used + cost > budget - 2:
+            break
+        kept.append(ch)
+        used += cost
+    trimmed[-1] = "".join(kept) + ellipsis
     return trimmed
 
 
-def create_slide(title: str, bullet: str, cfg: dict) -> Image.Image:
-    size_cfg = cfg.get("size", {})
-    width = int(size_cfg.get("width", 1080))
-    height = int(size_cfg.get("height", 1920))
-    safe_padding = int(cfg.get("layout", {}).get("safe_padding_px", 72))
-    max_chars = int(cfg.get("layout", {}).get("max_chars_per_line", 22))
-    line_spacing = float(cfg.get("layout", {}).get("line_spacing", 1.15))
+# Rasterized glyph masks keyed by (font path, font size, char). The title
+# repeats on every slide and Japanese bullets reuse many CJK codepoints, so
+# each unique glyph only hits FreeType once. Keyed by the face identity, not
+# id(font), so load_font cache eviction can never alias a stale mask, and
+# LRU-capped so long batch runs don't grow it without bound.
+_glyph_cache: OrderedDict[tuple, tuple[Image.Image, int]] = OrderedDict()
+_GLYPH_CACHE_MAX = 4096
+
+# Hex color strings come out of the config; parse each one once.
+_get_rgb = functools.lru_cache(maxsize=16)(ImageColor.getrgb)
+
+
+def _get_glyph(font: ImageFont.FreeTypeFont, ch: str) -> tuple[Image.Image, int]:
+    # Default fonts have no filesystem path (newer Pillow gives them a
+    # per-instance BytesIO .path); load_font's lru_cache keeps those
+    # instances stable, so their keys stay consistent within a process.
+    key = (getattr(font, "path", None), getattr(font, "size", None), ch)
+    cached = _glyph_cache.get(key)
+    if cached is None:
+        bbox = font.getbbox(ch)
+        w = max(int(bbox[2]), 1)
+        h = max(int(bbox[3]), 1)
+        mask = Image.new("L", (w, h), 0)
+        ImageDraw.Draw(mask).text((0, 0), ch, font=font, fill=255)
+        advance = int(font.getlength(ch))
+        cached = (mask, advance)
+        _glyph_cache[key] = cached
+        while len(_glyph_cache) > _GLYPH_CACHE_MAX:
+            _glyph_cache.popitem(last=False)
+    else:
+        _glyph_cache.move_to_end(key)
+    return cached
+
+
+def draw_cached_text(
+    img: Image.Image,
+    xy: tuple[int, int],
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    fill: str,
+    line_spacing: float = 1.0,
+) -> int:
+    """Draw text by pasting cached glyph masks instead of calling draw.text.
+
+    Embedded newlines are laid out like ImageDraw.multiline_text. Returns
+    the y coordinate just below the last drawn line.
+    """
+    left, y = int(xy[0]), int(xy[1])
+    color = _get_rgb(fill)
+    step = int(font.size * line_spacing)
+    for line in text.split("\n"):
+        x = left
+        for ch in line:
+            mask, advance = _get_glyph(font, ch)
+            img.paste(color, (x, y), mask=mask)
+            x += advance
+        y += step
+    return y
+
+
+@functools.lru_cache(maxsize=4)
+def _load_background(path_str: str, mtime: float, width: int, height: int) -> Image.Image:
+    bg = Image.open(path_str).convert("RGB")
+    if bg.size != (width, height):
+        bg = bg.resize((width, height), Image.BILINEAR)
+    return bg
+
+
+class SlideRenderer:
+    """Loads fonts and the background once, then stamps out one slide per bullet."""
+
+    def __init__(self, title: str, cfg: dict) -> None:
+        size_cfg = cfg.get("size", {})
+        self.width = int(size_cfg.get("width", 1080))
+        self.height = int(size_cfg.get("height", 1920))
+        layout = cfg.get("layout", {})
+        self.safe_padding = int(layout.get("safe_padding_px", 72))
+        self.max_chars = int(layout.get("max_chars_per_line", 22))
+        self.line_spacing = float(layout.get("line_spacing", 1.15))
+
+        self.title = title
+        self.title_font = load_font(cfg.get("fonts", {}).get("title"), size=72)
+        self.body_font = load_font(cfg.get("fonts", {}).get("body"), size=56)
 
-    bg_image_path = cfg.get("background", {}).get("image")
-    background = None
-    if bg_image_path:
-        bg_path = Path(bg_image_path)
-        if bg_path.exists():
-            background = Image.open(bg_path).convert("RGB").resize((width, height))
-    if background is None:
-        background = Image.new("RGB", (width, height), color="white")
+        colors = cfg.get("colors", {})
+        self.title_color = colors.get("fg_title", "#111111")
+        self.body_color = colors.get("fg_body", "#111111")
 
-    draw = ImageDraw.Draw(background)
+        bg_image_path = cfg.get("background", {}).get("image")
+        template = None
+        if bg_image_path:
+            bg_path = Path(bg_image_path)
+            if bg_path.exists():
+                # Copy so the title drawn below never touches the cached
+                # decode.
+                template = _load_background(
+                    str(bg_path),
+                    bg_path.stat().st_mtime,
+                    self.width,
+                    self.height,
+                ).copy()
+        if template is None:
+            template = Image.new("RGB", (self.width, self.height), color="white")
+        self.bg_template = template
 
-    title_font = load_font(cfg.get("fonts", {}).get("title"), size=72)
-    body_font = load_font(cfg.get("fonts", {}).get("body"), size=56)
+        # The title is identical on every slide, so draw it into the template
+        # once; create_slide only has to draw the bullet.
+        title_lines = wrap_lines(self.title, self.max_chars, max_lines=2)
+        y = draw_cached_text(
+            self.bg_template,
+            (self.safe_padding, self.safe_padding),
+            "\n".join(title_lines),
+            self.title_font,
+            self.title_color,
+            self.line_spacing,
+        )
+        self.body_start_y = y + int(self.title_font.size * 0.75)
 
-    colors = cfg.get("colors", {})
-    title_color = colors.get("fg_title", "#111111")
-    body_color = colors.get("fg_body", "#111111")
+    def create_slide(self, bullet: str) -> Image.Image:
+        img = self.bg_template.copy()
 
-    # Draw title
-    title_lines = wrap_lines(title, max_chars, max_lines=2)
-    y = safe_padding
-    for line in title_lines:
-        draw.text((safe_padding, y), line, font=title_font, fill=title_color)
-        y += int(title_font.size * line_spacing)
+        # Draw bullet text
+        bullet_lines = wrap_lines(bullet, self.max_chars, max_lines=2)
+        draw_cached_text(
+            img,
+            (self.safe_padding, self.body_start_y),
+            "\n".join(bullet_lines),
+            self.body_font,
+            self.body_color,
+            self.line_spacing,
+        )
+        return img
 
-    # Draw bullet text
-    bullet_lines = wrap_lines(bullet, max_chars, max_lines=2)
-    y += int(title_font.size * 0.75)
-    for line in bullet_lines:
-        draw.text((safe_padding, y), line, font=body_font, fill=body_color)
-        y += int(body_font.size * line_spacing)
 
-    return background
+FPS = 30
+
+# Per-worker renderer, built once by the pool initializer so each process
+# pays for fonts and the background exactly once.
+_worker_renderer: SlideRenderer | None = None
+
+
+def _init_slide_worker(title: str, cfg: dict) -> None:
+    global _worker_renderer
+    _worker_renderer = SlideRenderer(title, cfg)
+
+
+def _render_slide_to(job: tuple[str, str]) -> None:
+    bullet, out_path = job
+    _worker_renderer.create_slide(bullet).save(
+        out_path, optimize=False, compress_level=1
+    )
+
+
+def _render_slides(title: str, cfg: dict, jobs: list[tuple[str, str]]) -> None:
+    workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        _init_slide_worker(title, cfg)
+        for job in jobs:
+            _render_slide_to(job)
+        return
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_slide_worker,
+        initargs=(title, cfg),
+    ) as ex:
+        list(ex.map(_render_slide_to, jobs))
+
+
+@functools.lru_cache(maxsize=1)
+def _nvenc_available() -> bool:
+    # Listing -encoders only proves nvenc was compiled in; stock distro
+    # ffmpeg builds advertise it with no NVIDIA GPU present. Run a tiny
+    # test encode so GPU-less hosts fall back to libx264.
+    try:
+        probe = subprocess.run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel", "error",
+                "-f", "lavfi",
+                "-i", "color=black:s=64x64:d=0.1",
+                "-frames:v", "1",
+                "-c:v", "h264_nvenc",
+                "-f", "null",
+                "-",
+            ],
+            capture_output=True,
+        )
+    except OSError:
+        return False
+    return probe.returncode == 0
+
+
+def _codec_args(cfg: dict) -> list[str]:
+    codec = cfg.get("encoding", {}).get("codec")
+    if not codec:
+        codec = "h264_nvenc" if _nvenc_available() else "libx264"
+    if codec == "h264_nvenc":
+        return [
+            "-c:v", "h264_nvenc",
+            "-preset", "p4",
+            "-tune", "ll",
+            "-rc", "vbr",
+            "-cq", "23",
+        ]
+    if codec == "libx264":
+        # Slide decks are piecewise-constant frames: stillimage tuning plus
+        # a fast preset encodes far quicker at similar size, and a long
+        # keyint lets the duplicated frames collapse into near-empty
+        # P-frames.
+        return [
+            "-c:v", "libx264",
+            "-preset", "veryfast",
+            "-tune", "stillimage",
+            "-g", "900",
+        ]
+    return ["-c:v", str(codec)]
+
+
+def _encode_video(
+    concat_path: Path,
+    bgm_path: str | None,
+    cfg: dict,
+    total_duration: float,
+    output_path: Path,
+) -> None:
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", str(concat_path),
+    ]
+    if bgm_path is not None:
+        # apad plus the explicit -t cap keeps the video full-length when
+        # the BGM is shorter than the deck; -shortest would truncate the
+        # video to the audio instead.
+        cmd += [
+            "-i", str(bgm_path),
+            "-filter:a", "volume=0.25,apad",
+            "-c:a", "aac",
+            "-t", f"{total_duration:g}",
+        ]
+    cmd += ["-vf", f"fps={FPS}"]
+    cmd += _codec_args(cfg)
+    cmd += ["-pix_fmt", "yuv420p", str(output_path)]
+
+    proc = subprocess.run(cmd)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {proc.returncode}")
 
 
 def build_video(md_path: Path) -> Path:
     cfg = load_config(Path("config/style.yaml"))
     frontmatter, title, bullets = parse_markdown(md_path)
     duration = float(cfg.get("layout", {}).get("slide_sec", 7))
-    clips: list[ImageClip] = []
-    for bullet in bullets:
-        slide_img = create_slide(title, bullet, cfg)
-        clip = ImageClip(np.array(slide_img)).set_duration(duration)
-        clips.append(clip)
-
-    video = concatenate_videoclips(clips, method="compose")
-
-    bgm_path = frontmatter.get("bgm")
-    if bgm_path:
-        audio_file = Path(bgm_path)
-        if audio_file.exists():
-            try:
-                bgm_clip = AudioFileClip(str(audio_file)).volumex(0.25)
-                bgm_clip = bgm_clip.set_duration(video.duration)
-                video = video.set_audio(CompositeAudioClip([bgm_clip]))
-            except Exception:
-                pass
-
     output_path = md_path.with_suffix(".mp4")
-    video.write_videofile(
-        str(output_path),
-        fps=30,
-        codec="libx264",
-        audio_codec="aac",
-        verbose=False,
-        logger=None,
-    )
+
+    # Only len(bullets) unique frames exist, so hand ffmpeg one PNG per
+    # slide via the concat demuxer and let it duplicate frames internally
+    # instead of piping duration*fps copies of each frame through stdin.
+    with tempfile.TemporaryDirectory(prefix="yta_slides_") as tmp:
+        tmp_dir = Path(tmp)
+        slide_paths = [tmp_dir / f"{i:03d}.png" for i in range(len(bullets))]
+        jobs = [
+            (bullet, str(slide_path))
+            for bullet, slide_path in zip(bullets, slide_paths)
+        ]
+        _render_slides(title, cfg, jobs)
+
+        concat_lines = []
+        for slide_path in slide_paths:
+            concat_lines.append(f"file '{slide_path}'")
+            concat_lines.append(f"duration {duration}")
+        # The concat demuxer ignores the last duration unless the final
+        # file is repeated.
+        concat_lines.append(f"file '{slide_paths[-1]}'")
+        concat_path = tmp_dir / "concat.txt"
+        concat_path.write_text("\n".join(concat_lines) + "\n", encoding="utf-8")
+
+        bgm_path = frontmatter.get("bgm")
+        if not (bgm_path and Path(bgm_path).exists()):
+            bgm_path = None
+        _encode_video(
+            concat_path, bgm_path, cfg, len(bullets) * duration, output_path
+        )
     return output_path
 
 